@@ -2,303 +2,511 @@ import streamlit as st
 import sqlite3
 import pandas as pd
 import random
+import csv
+import io
 from datetime import date
 from typing import List, Tuple, Optional, Dict
 import os
+import threading
+import tempfile
+from contextlib import contextmanager
 
 DB_PATH = "data/sondagsholdet.db"
+ARCHIVE_PAGE_SIZE = 50
 
 # -------------- DB + Migration --------------
-def conn():
-    c = sqlite3.connect(DB_PATH)
-    c.execute("PRAGMA foreign_keys = ON;")
+def open_conn():
+    c = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    c.row_factory = sqlite3.Row
+    c.executescript("""
+        PRAGMA foreign_keys = ON;
+        PRAGMA busy_timeout = 5000;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -65536;
+        PRAGMA mmap_size = 268435456;
+    """)
     return c
 
-def table_columns(c, table):
+@st.cache_resource
+def get_conn():
+    # En delt skriveforbindelse pr. proces; holder SQLite's page cache varm mellem reruns.
+    return open_conn()
+
+@st.cache_resource
+def get_read_conn():
+    # Læsninger har deres egen forbindelse, så de kun ser committede data
+    # og aldrig en anden sessions åbne transaktion på skriveforbindelsen.
+    c = open_conn()
+    c.execute("PRAGMA query_only = ON;")
+    return c
+
+@st.cache_resource
+def get_write_lock():
+    # Serialiserer skrivninger på den delte forbindelse på tværs af sessioner
+    return threading.RLock()
+
+@contextmanager
+def transact():
+    # Én skrivetransaktion: skrivelås + BEGIN IMMEDIATE, commit ved succes og rollback ved fejl
+    with get_write_lock():
+        c = get_conn()
+        c.execute("BEGIN IMMEDIATE;")
+        try:
+            cur = c.cursor()
+            before = c.total_changes
+            yield cur
+            if c.total_changes != before:
+                bump_data_version(cur)
+            c.commit()
+        except BaseException:
+            c.rollback()
+            raise
+
+def schema_columns(c) -> Dict[str, set]:
+    # Alle tabeller og deres kolonner i ét opslag: {tabel: {kolonner}}
     cur = c.cursor()
-    try:
-        cur.execute(f"PRAGMA table_info({table});")
-        cols = [r[1] for r in cur.fetchall()]
-        return cols
-    except sqlite3.OperationalError:
-        return []
-
-def legacy_matches_columns(c):
-    cols = table_columns(c, "matches")
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    # Tabelnavnet bindes som parameter, så også navne som "my-log" virker
+    return {t: {r[0] for r in c.execute("SELECT name FROM pragma_table_info(?);", (t,))} for (t,) in cur.fetchall()}
+
+def legacy_matches_columns(cols: set):
     needed = {"id","session_id","is_doubles","side1_p1","side1_p2","side2_p1","side2_p2","winning_side","score1","score2","created_at"}
-    return needed.issubset(set(cols))
+    return needed.issubset(cols)
 
 def migrate_if_needed():
     os.makedirs("data", exist_ok=True)
-    c = conn(); cur = c.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS players(id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);")
-    # sessions table
-    sess_cols = table_columns(c, "sessions")
-    if sess_cols and ("sport" not in sess_cols):
-        cur.execute("ALTER TABLE sessions RENAME TO sessions_old;")
+    with get_write_lock():
+        c = get_conn(); cur = c.cursor()
+        # journal_mode gemmes i selve filen, så WAL skal kun slås til én gang
+        cur.execute("PRAGMA journal_mode = WAL;")
+        cur.execute("CREATE TABLE IF NOT EXISTS players(id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);")
+        # sessions table
+        schema = schema_columns(c)
+        sess_cols = schema.get("sessions", set())
+        if sess_cols and ("sport" not in sess_cols):
+            # Hele kopieringen i én transaktion: enten er tabellen migreret, eller også er intet ændret
+            with c:
+                cur.execute("BEGIN EXCLUSIVE;")
+                cur.execute("ALTER TABLE sessions RENAME TO sessions_old;")
+                cur.execute("""
+                    CREATE TABLE sessions(
+                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      session_date TEXT NOT NULL,
+                      sport TEXT NOT NULL,
+                      UNIQUE(session_date, sport)
+                    );
+                """)
+                cur.execute("SELECT id, session_date FROM sessions_old;")
+                cur.executemany("INSERT INTO sessions(id, session_date, sport) VALUES (?,?,?);",
+                                [(sid, d, "Pickleball") for sid, d in cur.fetchall()])
+                cur.execute("DROP TABLE sessions_old;")
         cur.execute("""
-            CREATE TABLE sessions(
+            CREATE TABLE IF NOT EXISTS sessions(
               id INTEGER PRIMARY KEY AUTOINCREMENT,
               session_date TEXT NOT NULL,
               sport TEXT NOT NULL,
               UNIQUE(session_date, sport)
             );
         """)
-        cur.execute("SELECT id, session_date FROM sessions_old;")
-        for sid, d in cur.fetchall():
-            cur.execute("INSERT INTO sessions(id, session_date, sport) VALUES (?,?,?);", (sid, d, "Pickleball"))
-        cur.execute("DROP TABLE sessions_old;")
-        c.commit()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS sessions(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          session_date TEXT NOT NULL,
-          sport TEXT NOT NULL,
-          UNIQUE(session_date, sport)
-        );
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS attendance(
-          session_id INTEGER NOT NULL,
-          player_id INTEGER NOT NULL,
-          PRIMARY KEY(session_id, player_id),
-          FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE,
-          FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-        );
-    """)
-    new_matches_cols = table_columns(c, "matches")
-    has_new_schema = set(["id","session_id","sport","team_size","score1","score2","winning_side","created_at"]).issubset(set(new_matches_cols))
-    if not has_new_schema and legacy_matches_columns(c):
-        cur.execute("ALTER TABLE matches RENAME TO matches_old;")
         cur.execute("""
-            CREATE TABLE matches(
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
+            CREATE TABLE IF NOT EXISTS attendance(
               session_id INTEGER NOT NULL,
-              sport TEXT NOT NULL,
-              team_size INTEGER NOT NULL,
-              score1 INTEGER,
-              score2 INTEGER,
-              winning_side INTEGER NOT NULL,
-              created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-              FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS match_players(
-              match_id INTEGER NOT NULL,
-              side INTEGER NOT NULL,
               player_id INTEGER NOT NULL,
-              PRIMARY KEY(match_id, side, player_id),
-              FOREIGN KEY(match_id) REFERENCES matches(id) ON DELETE CASCADE,
+              PRIMARY KEY(session_id, player_id),
+              FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE,
               FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
             );
         """)
-        cur.execute("SELECT id, session_id, is_doubles, side1_p1, side1_p2, side2_p1, side2_p2, winning_side, score1, score2, created_at FROM matches_old;")
-        for (mid, sid, is_d, a1,a2,b1,b2, wside, sc1, sc2, created) in cur.fetchall():
-            team_size = 2 if is_d==1 else 1
-            sport = "Pickleball"
-            cur.execute("INSERT INTO matches(id, session_id, sport, team_size, score1, score2, winning_side, created_at) VALUES (?,?,?,?,?,?,?,?);",
-                        (mid, sid, sport, team_size, sc1, sc2, wside, created))
-            side1 = [a1] + ([a2] if a2 else [])
-            side2 = [b1] + ([b2] if b2 else [])
-            for p in side1:
-                cur.execute("INSERT OR IGNORE INTO match_players(match_id, side, player_id) VALUES (?,?,?)", (mid,1,p))
-            for p in side2:
-                cur.execute("INSERT OR IGNORE INTO match_players(match_id, side, player_id) VALUES (?,?,?)", (mid,2,p))
-        cur.execute("DROP TABLE matches_old;")
-        c.commit()
-    else:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS matches(
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              session_id INTEGER NOT NULL,
-              sport TEXT NOT NULL,
-              team_size INTEGER NOT NULL,
-              score1 INTEGER,
-              score2 INTEGER,
-              winning_side INTEGER NOT NULL,
-              created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-              FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE
-            );
-        """)
+        new_matches_cols = schema.get("matches", set())
+        has_new_schema = set(["id","session_id","sport","team_size","score1","score2","winning_side","created_at"]).issubset(new_matches_cols)
+        is_legacy = not has_new_schema and legacy_matches_columns(new_matches_cols)
+        if is_legacy:
+            # Hele kopieringen i én transaktion: enten er tabellen migreret, eller også er intet ændret
+            with c:
+                cur.execute("BEGIN EXCLUSIVE;")
+                cur.execute("ALTER TABLE matches RENAME TO matches_old;")
+                cur.execute("""
+                    CREATE TABLE matches(
+                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      session_id INTEGER NOT NULL,
+                      sport TEXT NOT NULL,
+                      team_size INTEGER NOT NULL,
+                      score1 INTEGER,
+                      score2 INTEGER,
+                      winning_side INTEGER NOT NULL,
+                      created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                      match_sig TEXT,
+                      FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE
+                    );
+                """)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS match_players(
+                      match_id INTEGER NOT NULL,
+                      side INTEGER NOT NULL,
+                      player_id INTEGER NOT NULL,
+                      PRIMARY KEY(match_id, side, player_id),
+                      FOREIGN KEY(match_id) REFERENCES matches(id) ON DELETE CASCADE,
+                      FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+                    );
+                """)
+                cur.execute("SELECT id, session_id, is_doubles, side1_p1, side1_p2, side2_p1, side2_p2, winning_side, score1, score2, created_at FROM matches_old;")
+                matches_payload = []; mp_payload = []
+                for (mid, sid, is_d, a1,a2,b1,b2, wside, sc1, sc2, created) in cur.fetchall():
+                    team_size = 2 if is_d==1 else 1
+                    matches_payload.append((mid, sid, "Pickleball", team_size, sc1, sc2, wside, created))
+                    side1 = [a1] + ([a2] if a2 else [])
+                    side2 = [b1] + ([b2] if b2 else [])
+                    mp_payload += [(mid,1,p) for p in side1] + [(mid,2,p) for p in side2]
+                cur.executemany("INSERT INTO matches(id, session_id, sport, team_size, score1, score2, winning_side, created_at) VALUES (?,?,?,?,?,?,?,?);",
+                                matches_payload)
+                cur.executemany("INSERT OR IGNORE INTO match_players(match_id, side, player_id) VALUES (?,?,?)", mp_payload)
+                cur.execute("DROP TABLE matches_old;")
+        else:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS matches(
+                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  session_id INTEGER NOT NULL,
+                  sport TEXT NOT NULL,
+                  team_size INTEGER NOT NULL,
+                  score1 INTEGER,
+                  score2 INTEGER,
+                  winning_side INTEGER NOT NULL,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  match_sig TEXT,
+                  FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE
+                );
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS match_players(
+                  match_id INTEGER NOT NULL,
+                  side INTEGER NOT NULL,
+                  player_id INTEGER NOT NULL,
+                  PRIMARY KEY(match_id, side, player_id),
+                  FOREIGN KEY(match_id) REFERENCES matches(id) ON DELETE CASCADE,
+                  FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
+                );
+            """)
+        # Nyoprettede og legacy-migrerede tabeller har allerede kolonnen
+        if new_matches_cols and not is_legacy and "match_sig" not in new_matches_cols:
+            cur.execute("ALTER TABLE matches ADD COLUMN match_sig TEXT;")
+        # Udfyld signatur for kampe gemt før kolonnen fandtes (inkl. legacy-migrerede)
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS match_players(
-              match_id INTEGER NOT NULL,
-              side INTEGER NOT NULL,
-              player_id INTEGER NOT NULL,
-              PRIMARY KEY(match_id, side, player_id),
-              FOREIGN KEY(match_id) REFERENCES matches(id) ON DELETE CASCADE,
-              FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
-            );
+            SELECT m.id, m.score1, m.score2, mp.side, mp.player_id
+            FROM matches m JOIN match_players mp ON mp.match_id = m.id
+            WHERE m.match_sig IS NULL;
         """)
-    c.commit(); c.close()
+        unsigned = {}
+        for mid, sc1, sc2, side, pid in cur.fetchall():
+            unsigned.setdefault(mid, {"scores": (sc1, sc2), 1: [], 2: []})[side].append(pid)
+        if unsigned:
+            cur.executemany("UPDATE matches SET match_sig=? WHERE id=?;",
+                            [(match_signature(m[1], m[2], *m["scores"]), mid) for mid, m in unsigned.items()])
+        # attendance og match_players er allerede dækket af deres primærnøgler
+        # idx_matches_sig dækker også opslag på session_id alene
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_matches_sig ON matches(session_id, match_sig);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_sport_date ON sessions(sport, session_date);")
+        # Planner-statistik første gang; PRAGMA optimize holder den frisk bagefter
+        if "sqlite_stat1" not in schema:
+            cur.execute("ANALYZE;")
+        c.commit()
+
+@st.cache_resource
+def init_db():
+    # Mappe, migration og DDL køres én gang pr. proces i stedet for ved hver rerun
+    migrate_if_needed()
+    get_conn().execute("PRAGMA optimize;")
+    return True
+
+def bump_data_version(cur):
+    # Ændringstælleren ligger i databasens header og øges i samme transaktion som skrivningen
+    cur.execute("PRAGMA user_version;")
+    cur.execute(f"PRAGMA user_version = {int(cur.fetchone()[0]) + 1};")
+
+def data_version() -> int:
+    # Cache-nøgle for beregnede tabeller: én header-læsning, der ændres ved hver skrivning i appen
+    return get_read_conn().execute("PRAGMA user_version;").fetchone()[0]
+
+def clear_caches():
+    # Kaldes efter hver skrivning, så cachede beregninger aldrig er forældede
+    st.cache_data.clear()
+    # db_bytes og all_matches_csv er cache_resource og ryddes derfor ikke af cache_data.clear()
+    db_bytes.clear()
+    all_matches_csv.clear()
+
+def year_bounds(year: int) -> Tuple[str, str]:
+    # Halvåbent datointerval, så UNIQUE(session_date, sport)-indekset kan bruges
+    return (f"{int(year):04d}-01-01", f"{int(year)+1:04d}-01-01")
 
 def get_or_create_session(d: date, sport: str) -> int:
-    c = conn(); cur = c.cursor()
+    cur = get_read_conn().cursor()
     ds = d.isoformat()
-    cur.execute("INSERT OR IGNORE INTO sessions(session_date, sport) VALUES (?,?);", (ds, sport))
-    c.commit()
+    # Kaldes ved hver rerun: ren læsning når sessionen findes, ellers én UPSERT
     cur.execute("SELECT id FROM sessions WHERE session_date=? AND sport=?;", (ds, sport))
     sid_row = cur.fetchone()
     if not sid_row:
-        # fallback create explicitly
-        cur.execute("INSERT INTO sessions(session_date, sport) VALUES (?,?);", (ds, sport))
-        c.commit()
-        cur.execute("SELECT id FROM sessions WHERE session_date=? AND sport=?;", (ds, sport))
-        sid_row = cur.fetchone()
-    sid = sid_row[0]
-    c.close()
-    return sid
-
-def list_players():
-    c = conn(); cur = c.cursor()
+        with transact() as cur:
+            cur.execute("""
+                INSERT INTO sessions(session_date, sport) VALUES (?,?)
+                ON CONFLICT(session_date, sport) DO UPDATE SET sport=excluded.sport RETURNING id;
+            """, (ds, sport))
+            sid_row = cur.fetchone()
+    return sid_row[0]
+
+@st.cache_data(show_spinner=False)
+def list_players(version: int) -> List[Tuple[int, str]]:
+    cur = get_read_conn().cursor()
     cur.execute("SELECT id,name FROM players ORDER BY name COLLATE NOCASE;")
-    rows = cur.fetchall(); c.close(); return rows
+    return [tuple(r) for r in cur.fetchall()]
 
 def add_player(name: str):
     name = (name or '').strip()
     if not name: return None
-    c = conn(); cur = c.cursor()
-    cur.execute("INSERT OR IGNORE INTO players(name) VALUES (?);", (name,))
-    c.commit()
-    cur.execute("SELECT id FROM players WHERE name=?;", (name,))
-    row = cur.fetchone(); c.close()
+    with transact() as cur:
+        cur.execute("""
+            INSERT INTO players(name) VALUES (?)
+            ON CONFLICT(name) DO UPDATE SET name=excluded.name RETURNING id;
+        """, (name,))
+        row = cur.fetchone()
+    clear_caches()
     return row[0] if row else None
 
 def record_attendance(session_id: int, player_ids: List[int]):
-    c = conn(); cur = c.cursor()
-    cur.execute("DELETE FROM attendance WHERE session_id=?;", (session_id,))
-    for pid in player_ids:
-        cur.execute("INSERT OR IGNORE INTO attendance(session_id, player_id) VALUES (?,?);", (session_id, pid))
-    c.commit(); c.close()
-
-def list_attendance(session_id: int) -> List[int]:
-    c = conn(); cur = c.cursor()
+    # Skriv kun forskellen mellem gemt og valgt fremmøde
+    picked = set(player_ids)
+    with transact() as cur:
+        cur.execute("SELECT player_id FROM attendance WHERE session_id=?;", (session_id,))
+        existing = {r[0] for r in cur.fetchall()}
+        cur.executemany("DELETE FROM attendance WHERE session_id=? AND player_id=?;",
+                        [(session_id, pid) for pid in existing - picked])
+        cur.executemany("INSERT OR IGNORE INTO attendance(session_id, player_id) VALUES (?,?);",
+                        [(session_id, pid) for pid in picked - existing])
+    clear_caches()
+
+@st.cache_data(show_spinner=False)
+def list_attendance(session_id: int, version: int) -> List[int]:
+    cur = get_read_conn().cursor()
     cur.execute("SELECT player_id FROM attendance WHERE session_id=?;", (session_id,))
-    rows = [r[0] for r in cur.fetchall()]
-    c.close(); return rows
+    return [r[0] for r in cur.fetchall()]
 
 def delete_session_data(session_id: int):
-    c = conn(); cur = c.cursor()
-    cur.execute("DELETE FROM match_players WHERE match_id IN (SELECT id FROM matches WHERE session_id=?);", (session_id,))
-    cur.execute("DELETE FROM matches WHERE session_id=?;", (session_id,))
-    cur.execute("DELETE FROM attendance WHERE session_id=?;", (session_id,))
-    cur.execute("DELETE FROM sessions WHERE id=?;", (session_id,))
-    c.commit(); c.close()
+    with transact() as cur:
+        # ON DELETE CASCADE fjerner kampe, kampspillere og fremmøde
+        cur.execute("DELETE FROM sessions WHERE id=?;", (session_id,))
+    clear_caches()
 
 def reset_all():
-    c = conn(); cur = c.cursor()
-    cur.executescript("""
-    DROP TABLE IF EXISTS match_players;
-    DROP TABLE IF EXISTS matches;
-    DROP TABLE IF EXISTS attendance;
-    DROP TABLE IF EXISTS sessions;
-    DROP TABLE IF EXISTS players;
-    """)
-    c.commit(); c.close()
-    migrate_if_needed()
+    with get_write_lock():
+        c = get_conn(); cur = c.cursor()
+        # DROP og genopbygning i én transaktion; migrate_if_needed committer til sidst
+        cur.executescript("""
+        BEGIN;
+        DROP TABLE IF EXISTS match_players;
+        DROP TABLE IF EXISTS matches;
+        DROP TABLE IF EXISTS attendance;
+        DROP TABLE IF EXISTS sessions;
+        DROP TABLE IF EXISTS players;
+        """)
+        try:
+            # Id'er starter forfra efter DROP, så kun tælleren adskiller før og efter
+            bump_data_version(cur)
+            migrate_if_needed()
+        except Exception:
+            c.rollback()
+            raise
+    clear_caches()
+
+def restore_db(data: bytes):
+    # Gendannes gennem SQLite's backup-API, så filen aldrig overskrives under åbne forbindelser.
+    # Filer, der ikke er en database, giver sqlite3.DatabaseError før noget røres;
+    # fejl under selve gendannelsen kommer som sqlite3.OperationalError.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, "upload.db")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        src = sqlite3.connect(tmp_path)
+        try:
+            src_page_size = src.execute("PRAGMA page_size;").fetchone()[0]
+            src.execute("PRAGMA schema_version;")
+            # En WAL-database kan ikke skifte sidestørrelse under backup, så kopien tilpasses først
+            # (fx 1024 bytes fra filer lavet før SQLite 3.12)
+            page_size = get_read_conn().execute("PRAGMA page_size;").fetchone()[0]
+            if src_page_size != page_size:
+                src.execute("PRAGMA journal_mode = DELETE;")
+                src.execute(f"PRAGMA page_size = {int(page_size)};")
+                src.execute("VACUUM;")
+            with get_write_lock():
+                c = get_conn()
+                old_version = c.execute("PRAGMA user_version;").fetchone()[0]
+                src.backup(c)
+                migrate_if_needed()
+                # Den uploadede fil har sin egen tæller; fortsæt over begge, så ingen gammel nøgle genbruges
+                new_version = max(old_version, c.execute("PRAGMA user_version;").fetchone()[0]) + 1
+                c.execute(f"PRAGMA user_version = {int(new_version)};")
+        finally:
+            src.close()
+    clear_caches()
 
 # -------------- Duplicate guard --------------
 def canonical_side(players: List[int]) -> Tuple[int,...]:
     return tuple(sorted(players))
 
-def match_duplicate_exists(session_id: int, sport: str, team_size: int, side1: List[int], side2: List[int], score1: int, score2: int) -> bool:
+def match_signature(side1: List[int], side2: List[int], score1: Optional[int], score2: Optional[int]) -> str:
+    # Samme kamp giver samme signatur uanset side-rækkefølge, fx "1,5|2,9|11-7"
     s1 = canonical_side(side1); s2 = canonical_side(side2)
     if s2 < s1:
         s1, s2 = s2, s1
         score1, score2 = score2, score1
-    c = conn(); c.row_factory = sqlite3.Row; cur = c.cursor()
-    cur.execute("SELECT id, score1, score2 FROM matches WHERE session_id=? AND sport=? AND team_size=?;", (session_id, sport, team_size))
-    mats = cur.fetchall()
-    if not mats:
-        c.close(); return False
-    ids = [m["id"] for m in mats]
-    ph = ",".join("?"*len(ids))
-    cur.execute(f"SELECT match_id, side, player_id FROM match_players WHERE match_id IN ({ph})", ids)
-    rows = cur.fetchall()
-    c.close()
-    by_match = {}
-    for r in rows:
-        by_match.setdefault(r["match_id"], {1:[],2:[]})[r["side"]].append(r["player_id"])
-    for m in mats:
-        mp = by_match.get(m["id"], {1:[],2:[]})
-        a = canonical_side(mp.get(1,[])); b = canonical_side(mp.get(2,[]))
-        ra, rb = (a,b) if a<=b else (b,a)
-        rsc1, rsc2 = (m["score1"], m["score2"]) if (a,b)==(ra,rb) else (m["score2"], m["score1"])
-        if ra==s1 and rb==s2 and rsc1==score1 and rsc2==score2:
-            return True
-    return False
+    return "|".join([",".join(map(str, s1)), ",".join(map(str, s2)), f"{score1}-{score2}"])
+
+def match_duplicate_exists(session_id: int, sport: str, team_size: int, side1: List[int], side2: List[int], score1: int, score2: int) -> bool:
+    # Kaldes inde i transact(), så opslaget ligger på skriveforbindelsen
+    cur = get_conn().cursor()
+    cur.execute("SELECT 1 FROM matches WHERE session_id=? AND match_sig=? AND sport=? AND team_size=? LIMIT 1;",
+                (session_id, match_signature(side1, side2, score1, score2), sport, team_size))
+    return cur.fetchone() is not None
 
 def save_match(session_id: int, sport: str, team_size: int, side1: List[int], side2: List[int], score1: int, score2: int) -> bool:
-    if match_duplicate_exists(session_id, sport, team_size, side1, side2, score1, score2):
-        return False
     winner = 1 if score1>score2 else 2
-    c = conn(); cur = c.cursor()
-    cur.execute("""
-        INSERT INTO matches(session_id, sport, team_size, score1, score2, winning_side) VALUES (?,?,?,?,?,?);
-    """, (session_id, sport, team_size, score1, score2, winner))
-    mid = cur.lastrowid
-    for pid in side1:
-        cur.execute("INSERT INTO match_players(match_id, side, player_id) VALUES (?,?,?)", (mid,1,pid))
-    for pid in side2:
-        cur.execute("INSERT INTO match_players(match_id, side, player_id) VALUES (?,?,?)", (mid,2,pid))
-    c.commit(); c.close()
+    # Dublet-tjek og indsættelse i samme transaktion, så to hurtige klik ikke gemmer kampen to gange
+    with transact() as cur:
+        if match_duplicate_exists(session_id, sport, team_size, side1, side2, score1, score2):
+            return False
+        cur.execute("""
+            INSERT INTO matches(session_id, sport, team_size, score1, score2, winning_side, match_sig) VALUES (?,?,?,?,?,?,?);
+        """, (session_id, sport, team_size, score1, score2, winner, match_signature(side1, side2, score1, score2)))
+        mid = cur.lastrowid
+        cur.executemany("INSERT INTO match_players(match_id, side, player_id) VALUES (?,?,?)",
+                        [(mid,1,pid) for pid in side1] + [(mid,2,pid) for pid in side2])
+    clear_caches()
     return True
 
 # -------------- Stats --------------
-def compute_standings(year: int, sport: str) -> pd.DataFrame:
-    c = conn(); cur = c.cursor()
-    cur.execute("SELECT id,name FROM players;")
-    players = dict(cur.fetchall())
-    if not players:
-        c.close(); return pd.DataFrame()
-    cur.execute("SELECT id FROM sessions WHERE strftime('%Y', session_date)=? AND sport=?;", (str(year), sport))
-    sids = [r[0] for r in cur.fetchall()]
-    if not sids:
-        c.close(); return pd.DataFrame()
-    sid_tuple = "(" + ",".join("?"*len(sids)) + ")"
-    cur.execute(f"SELECT player_id, COUNT(*) FROM attendance WHERE session_id IN {sid_tuple} GROUP BY player_id;", sids)
-    attendance = dict(cur.fetchall())
-    cur.execute(f"SELECT id, winning_side FROM matches WHERE session_id IN {sid_tuple};", sids)
-    rows = cur.fetchall()
-    wins = {pid:0 for pid in players}; losses = {pid:0 for pid in players}; played = {pid:0 for pid in players}
-    for (mid, wside) in rows:
-        cur.execute("SELECT side, player_id FROM match_players WHERE match_id=?;", (mid,))
-        parts = cur.fetchall()
-        s1 = [p[1] for p in parts if p[0]==1]; s2 = [p[1] for p in parts if p[0]==2]
-        for p in s1+s2: played[p]=played.get(p,0)+1
-        winners = s1 if wside==1 else s2
-        losers  = s2 if wside==1 else s1
-        for p in winners: wins[p]=wins.get(p,0)+1
-        for p in losers: losses[p]=losses.get(p,0)+1
-    data = []
-    for pid,name in players.items():
-        att = attendance.get(pid,0); mp=played.get(pid,0); w=wins.get(pid,0); l=losses.get(pid,0)
-        total = att*1 + w*3
-        winpct = round((w/mp)*100,1) if mp>0 else 0.0
-        data.append([name, att, mp, w, l, winpct, total])
-    df = pd.DataFrame(data, columns=["Spiller","Fremmøder","Kampe","Sejre","Nederlag","Sejr-%","Point i alt"])
+@st.cache_data(show_spinner=False)
+def load_year_matches(year: int, sport: str, version: int) -> pd.DataFrame:
+    # Årets kampe i langt format (én række pr. kamp og spiller) til arkivet
+    return pd.read_sql_query("""
+        SELECT m.id AS match_id, s.session_date, COALESCE(m.score1,'') || '-' || COALESCE(m.score2,'') AS result,
+               m.winning_side, mp.side, mp.player_id, COALESCE(p.name,'?') AS name
+        FROM sessions s
+        JOIN matches m ON m.session_id = s.id
+        JOIN match_players mp ON mp.match_id = m.id
+        LEFT JOIN players p ON p.id = mp.player_id
+        WHERE s.session_date>=? AND s.session_date<? AND s.sport=?
+        ORDER BY m.id DESC, mp.side, mp.player_id;
+    """, get_read_conn(), params=(*year_bounds(year), sport))
+
+def archive_table(parts: pd.DataFrame) -> pd.DataFrame:
+    # Navne pr. side samles med groupby/unstack i stedet for en løkke pr. kamp
+    sides = (parts.groupby(["match_id","side"], sort=False)["name"].agg(" & ".join)
+             .unstack("side").reindex(columns=[1,2]).fillna(""))
+    return (parts.drop_duplicates("match_id").set_index("match_id")[["session_date","result"]]
+            .join(sides).reset_index(drop=True)
+            .rename(columns={"session_date": "Dato", 1: "Side 1", 2: "Side 2", "result": "Resultat"})
+            [["Dato","Side 1","Side 2","Resultat"]])
+
+@st.cache_data(show_spinner=False)
+def compute_standings(year: int, sport: str, version: int) -> pd.DataFrame:
+    # version (fra data_version) indgår kun som cache-nøgle
+    cur = get_read_conn().cursor()
+    lo, hi = year_bounds(year)
+    cur.execute("SELECT EXISTS(SELECT 1 FROM sessions WHERE session_date>=? AND session_date<? AND sport=?);", (lo, hi, sport))
+    if not cur.fetchone()[0]:
+        return pd.DataFrame()
+    # Fremmøder, kampe og sejre pr. spiller aggregeres i én SQL-forespørgsel
+    df = pd.read_sql_query("""
+        WITH yr AS (
+            SELECT id FROM sessions WHERE session_date>=? AND session_date<? AND sport=?
+        ), att AS (
+            SELECT player_id, COUNT(*) AS att FROM attendance
+            WHERE session_id IN (SELECT id FROM yr) GROUP BY player_id
+        ), res AS (
+            SELECT mp.player_id, COUNT(*) AS mp, SUM(mp.side = m.winning_side) AS w
+            FROM matches m JOIN match_players mp ON mp.match_id = m.id
+            WHERE m.session_id IN (SELECT id FROM yr) GROUP BY mp.player_id
+        )
+        SELECT p.name AS "Spiller", COALESCE(att.att,0) AS "Fremmøder",
+               COALESCE(res.mp,0) AS "Kampe", COALESCE(res.w,0) AS "Sejre"
+        FROM players p
+        LEFT JOIN att ON att.player_id = p.id
+        LEFT JOIN res ON res.player_id = p.id;
+    """, get_read_conn(), params=(lo, hi, sport))
+    if df.empty:
+        return df
+    df["Nederlag"] = df["Kampe"] - df["Sejre"]
+    df["Sejr-%"] = (df["Sejre"] / df["Kampe"].where(df["Kampe"] > 0) * 100).round(1).fillna(0.0)
+    df["Point i alt"] = df["Fremmøder"] + df["Sejre"]*3
     df = df.sort_values(["Point i alt","Sejre","Spiller"], ascending=[False,False,True]).reset_index(drop=True)
     # Placering starter ved 1
     df.index = df.index + 1
     df.index.name = "Placering"
-    c.close(); return df
+    return df
+
+# -------------- Export --------------
+@st.cache_data(show_spinner=False)
+def archive_csv(year: int, sport: str, version: int) -> bytes:
+    return archive_table(load_year_matches(year, sport, version)).to_csv(index=False, lineterminator="\n").encode("utf-8")
+
+@st.cache_data(show_spinner=False)
+def standings_csv(year: int, sport: str, version: int) -> bytes:
+    return compute_standings(year, sport, version).to_csv(lineterminator="\n").encode("utf-8")
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def db_bytes(version: int) -> bytes:
+    # Øjebliksbillede via backup-API'et (inkl. WAL-indhold) under skrivelåsen; bygges kun, når data ændres.
+    # cache_resource deler det samme bytes-objekt i stedet for at kopiere det ved hver rerun.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, "sondagsholdet.db")
+        dst = sqlite3.connect(tmp_path)
+        try:
+            with get_write_lock():
+                get_conn().backup(dst)
+        finally:
+            dst.close()
+        with open(tmp_path, "rb") as f:
+            return f.read()
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def all_matches_csv(version: int) -> Optional[bytes]:
+    # Skrives fra cursoren i bidder direkte som UTF-8, uden DataFrame og uden en ekstra encode-kopi.
+    # Nøglet på data_version, så alle sessioner får samme, aktuelle eksport.
+    cur = get_read_conn().cursor()
+    cur.execute("""
+        SELECT m.id, s.session_date, s.sport, m.team_size, m.score1, m.score2, m.winning_side,
+               GROUP_CONCAT(CASE WHEN mp.side=1 THEN p.name END, ' & ') AS side1,
+               GROUP_CONCAT(CASE WHEN mp.side=2 THEN p.name END, ' & ') AS side2
+        FROM matches m
+        JOIN sessions s ON s.id = m.session_id
+        LEFT JOIN match_players mp ON mp.match_id = m.id
+        LEFT JOIN players p ON p.id = mp.player_id
+        GROUP BY m.id
+        ORDER BY m.id DESC
+    """)
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding="utf-8", newline="")
+    w = csv.writer(text, lineterminator="\n")
+    w.writerow([d[0] for d in cur.description])
+    n = 0
+    while True:
+        chunk = cur.fetchmany(1000)
+        if not chunk:
+            break
+        w.writerows(chunk)
+        n += len(chunk)
+    text.flush()
+    text.detach()
+    return buf.getvalue() if n else None
 
 # -------------- Round generator --------------
-def make_round_matches(att_ids: List[int], courts: int, team_size: int, mix_mode: str) -> List[Dict]:
+def make_round_matches(att_ids: List[int], courts: int, team_size: int, mix_mode: str, pid2name: Dict[int, str]) -> List[Dict]:
     if not att_ids or courts<=0 or team_size<=0: return []
-    ids = att_ids[:]
-    c = conn(); cur = c.cursor()
-    q = "SELECT id,name FROM players WHERE id IN (%s)" % ",".join("?"*len(ids))
-    cur.execute(q, ids)
-    names = {pid: n for pid,n in cur.fetchall()}
-    c.close()
+    per_match = 2*team_size
+    max_matches = min(len(att_ids)//per_match, courts)
+    # Træk kun de spillere, der faktisk skal bruges
     if mix_mode == "Snake (balanceret)":
-        ids.sort(key=lambda p: names.get(p,"").lower())
+        ids = sorted(att_ids, key=lambda p: pid2name.get(p,"").lower())[:max_matches*per_match]
     else:
-        random.shuffle(ids)
-    per_match = 2*team_size
-    max_matches = min(len(ids)//per_match, courts)
+        ids = random.sample(att_ids, max_matches*per_match)
     matches = []
     used = 0
     for _ in range(max_matches):
@@ -321,23 +529,29 @@ def sport_tab_ui(sport: str, default_team_size: int, team_min: int, team_max: in
     with col3:
         courts = st.number_input("Baner", min_value=1, max_value=8, value=2, step=1, key=f"courts_{sport}")
     # Attendance
-    players = list_players()
+    # Cachede lister nøgles på data_version, så en overlappende skrivning ikke efterlader forældede data
+    version = data_version()
+    players = list_players(version)
     pid2name = {pid:name for pid,name in players}
+    name2pid = {name:pid for pid,name in players}
     st.subheader("Fremmøde")
-    picked = st.multiselect("Vælg spillere", [name for _,name in players], default=[pid2name.get(pid) for pid in list_attendance(session_id)], key=f"att_{sport}")
-    picked_ids = [pid for pid,name in players if name in picked]
+    att_ids = list_attendance(session_id, version)
+    default_names = [pid2name[pid] for pid in att_ids if pid in pid2name]
+    picked = st.multiselect("Vælg spillere", [name for _,name in players], default=default_names, key=f"att_{sport}")
+    # Navne, der ikke længere findes (fx efter "Ryd ALT" eller upload), springes over
+    picked_ids = [name2pid[name] for name in picked if name in name2pid]
     if st.button("Gem fremmøde", key=f"save_att_{sport}"):
         record_attendance(session_id, picked_ids)
+        att_ids = picked_ids
         st.success("Fremmøde gemt.")
     # Controls
     st.subheader("Start spil")
     mix_mode = st.radio("Mixing", ["Random","Snake (balanceret)"], horizontal=True, key=f"mix_{sport}")
-    att_ids = list_attendance(session_id)
     if st.button("Start runde", key=f"start_round_{sport}"):
         if len(att_ids) < 2*team_size:
             st.warning(f"For få spillere til {team_size}v{team_size}.")
         else:
-            matches = make_round_matches(att_ids, int(courts), int(team_size), mix_mode)
+            matches = make_round_matches(att_ids, int(courts), int(team_size), mix_mode, pid2name)
             if not matches:
                 st.warning("Kunne ikke planlægge kampe til denne runde.")
             else:
@@ -373,47 +587,29 @@ def sport_tab_ui(sport: str, default_team_size: int, team_min: int, team_max: in
     # Archive
     st.subheader("Kamp-arkiv")
     year_choice = st.number_input("År", min_value=2000, max_value=2100, value=date.today().year, step=1, key=f"year_{sport}")
-    c = conn(); c.row_factory = sqlite3.Row; cur = c.cursor()
-    cur.execute("SELECT id FROM sessions WHERE strftime('%Y', session_date)=? AND sport=?;", (str(year_choice), sport))
-    sids = [r[0] for r in cur.fetchall()]
-    rows = []
-    if sids:
-        sid_tuple = "(" + ",".join("?"*len(sids)) + ")"
-        cur.execute(f"SELECT id, score1, score2, winning_side FROM matches WHERE session_id IN {sid_tuple} ORDER BY id DESC;", sids)
-        mats = cur.fetchall()
-        for m in mats:
-            mid = m["id"]
-            cur.execute("SELECT side, player_id FROM match_players WHERE match_id=?;", (mid,))
-            parts = cur.fetchall()
-            s1 = [p[1] for p in parts if p[0]==1]; s2 = [p[1] for p in parts if p[0]==2]
-            rows.append((mid, m["score1"], m["score2"], m["winning_side"], s1, s2))
-    c.close()
-    players = list_players()
-    pid2name = {pid:name for pid,name in players}
-    table_rows = []
-    for mid, sc1, sc2, wside, s1, s2 in rows:
-        s1_names = " & ".join(pid2name.get(p,"?") for p in s1)
-        s2_names = " & ".join(pid2name.get(p,"?") for p in s2)
-        c = conn(); cur = c.cursor()
-        cur.execute("SELECT session_date FROM sessions WHERE id=(SELECT session_id FROM matches WHERE id=?);", (mid,))
-        drow = cur.fetchone(); c.close()
-        dstr = drow[0] if drow else ""
-        table_rows.append({"Dato": dstr, "Side 1": s1_names, "Side 2": s2_names, "Resultat": f"{sc1}-{sc2}"})
-    if table_rows:
-        df_arch = pd.DataFrame(table_rows)
-        st.dataframe(df_arch, use_container_width=True)
-        st.download_button("Download arkiv (CSV)", data=df_arch.to_csv(index=False).encode("utf-8"), file_name=f"{sport.lower()}_arkiv_{year_choice}.csv", mime="text/csv")
+    # Hentes igen, da fremmøde eller kampe kan være gemt ovenfor
+    version = data_version()
+    arch = load_year_matches(year_choice, sport, version)
+    if not arch.empty:
+        # Kun den viste side bygges til tabellen; CSV-downloaden dækker hele året
+        match_ids = arch["match_id"].unique()
+        n_pages = max(1, -(-len(match_ids) // ARCHIVE_PAGE_SIZE))
+        page = st.number_input("Side", min_value=1, max_value=n_pages, value=1, step=1, key=f"arch_page_{sport}")
+        page_ids = match_ids[(page-1)*ARCHIVE_PAGE_SIZE : page*ARCHIVE_PAGE_SIZE]
+        st.dataframe(archive_table(arch[arch["match_id"].isin(page_ids)]), use_container_width=True)
+        st.caption(f"Side {page} af {n_pages} ({len(match_ids)} kampe)")
+        st.download_button("Download arkiv (CSV)", data=archive_csv(year_choice, sport, version), file_name=f"{sport.lower()}_arkiv_{year_choice}.csv", mime="text/csv")
     else:
         st.caption("Ingen kampe endnu for det valgte år.")
     # League
     st.subheader("Liga")
     try:
-        liga_df = compute_standings(year_choice, sport)
+        liga_df = compute_standings(year_choice, sport, version)
     except Exception:
         liga_df = pd.DataFrame()
     if isinstance(liga_df, pd.DataFrame) and not liga_df.empty:
         st.dataframe(liga_df, use_container_width=True)
-        st.download_button("Download liga (CSV)", data=liga_df.to_csv().encode("utf-8"), file_name=f"{sport.lower()}_liga_{year_choice}.csv", mime="text/csv")
+        st.download_button("Download liga (CSV)", data=standings_csv(year_choice, sport, version), file_name=f"{sport.lower()}_liga_{year_choice}.csv", mime="text/csv")
     else:
         st.caption("Ingen data i ligaen endnu.")
 
@@ -421,8 +617,7 @@ def sport_tab_ui(sport: str, default_team_size: int, team_min: int, team_max: in
 st.set_page_config(page_title="Søndagsholdet F/S", layout="wide")
 st.title("Søndagsholdet F/S")
 
-os.makedirs("data", exist_ok=True)
-migrate_if_needed()
+init_db()
 
 with st.sidebar:
     st.header("Indstillinger")
@@ -433,33 +628,34 @@ with st.sidebar:
             pid = add_player(nm)
             if pid: st.success(f"Tilføjet: {nm}")
     # Backups
-    if os.path.exists(DB_PATH):
-        with open(DB_PATH, "rb") as f:
-            st.download_button("Download database (.db)", data=f.read(), file_name="sondagsholdet.db")
-    c = conn()
-    try:
-        df_all = pd.read_sql_query("""
-            SELECT m.id, s.session_date, s.sport, m.team_size, m.score1, m.score2, m.winning_side
-            FROM matches m JOIN sessions s ON s.id = m.session_id
-            ORDER BY m.id DESC
-        """, c)
-    except Exception:
-        df_all = pd.DataFrame()
-    finally:
-        c.close()
-    if not df_all.empty:
-        st.download_button("Download alle kampe (CSV)", data=df_all.to_csv(index=False).encode("utf-8"), file_name="alle_kampe.csv", mime="text/csv")
+    st.download_button("Download database (.db)", data=db_bytes(data_version()), file_name="sondagsholdet.db")
+    # Fuld eksport hentes først, når der bedes om den, ikke ved hver rerun
+    if st.button("Forbered CSV med alle kampe"):
+        st.session_state["all_matches_requested"] = True
+    if st.session_state.get("all_matches_requested"):
+        all_csv = all_matches_csv(data_version())
+        if all_csv is None:
+            st.info("Ingen kampe at eksportere endnu.")
+        else:
+            st.download_button("Download alle kampe (CSV)", data=all_csv, file_name="alle_kampe.csv", mime="text/csv")
     uploaded = st.file_uploader("Upload database (.db)", type=["db"])
-    if uploaded is not None:
-        with open(DB_PATH, "wb") as f:
-            f.write(uploaded.getbuffer())
-        st.success("Database gendannet. Genindlæs siden.")
+    # Samme upload skal kun gendannes én gang, ikke ved hver efterfølgende rerun
+    if uploaded is not None and st.session_state.get("restored_upload") != uploaded.file_id:
+        st.session_state["restored_upload"] = uploaded.file_id
+        try:
+            restore_db(uploaded.getvalue())
+        except sqlite3.OperationalError as e:
+            st.error(f"Databasen kunne ikke gendannes: {e}")
+        except sqlite3.DatabaseError:
+            st.error("Filen kunne ikke læses som en database.")
+        else:
+            st.success("Database gendannet. Genindlæs siden.")
     with st.expander("Ryd data"):
         st.caption("Slet testdata under udvikling.")
         del_sport = st.selectbox("Sport", ["Pickleball","Badminton","Volleyball","Indørs fodbold","Indørs hockey"], key="del_sport")
         del_date = st.date_input("Dato", value=date.today(), key="del_date")
         if st.button("Ryd dagens data for valgt sport"):
-            c = conn(); cur = c.cursor()
+            cur = get_read_conn().cursor()
             cur.execute("SELECT id FROM sessions WHERE session_date=? AND sport=?;", (del_date.isoformat(), del_sport))
             row = cur.fetchone()
             if row:
@@ -467,7 +663,6 @@ with st.sidebar:
                 st.success("Dagens data ryddet.")
             else:
                 st.info("Ingen session fundet for den dato/sport.")
-            c.close()
         if st.button("Ryd ALT (drop database)"):
             reset_all()
             st.success("Alt er ryddet.")